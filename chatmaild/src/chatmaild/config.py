@@ -51,9 +51,6 @@ class Config:
         # old unused option (except for first migration from sqlite to maildir store)
         self.passdb_path = Path(params.get("passdb_path", "/home/vmail/passdb.sqlite"))
 
-    def _getbytefile(self):
-        return open(self._inipath, "rb")
-
     def get_user(self, addr):
         if not addr or "@" not in addr or "/" in addr:
             raise ValueError(f"invalid address {addr!r}")
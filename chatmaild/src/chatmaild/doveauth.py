@@ -1,3 +1,5 @@
+import ctypes
+import ctypes.util
 import json
 import logging
 import os
@@ -14,10 +16,49 @@ from .migrate_db import migrate_from_db_to_maildir
 
 NOCREATE_FILE = "/etc/chatmail-nocreate"
 
+# large enough for both glibc's and libxcrypt's "struct crypt_data"
+CRYPT_DATA_SIZE = 256 * 1024
+
+
+def _load_libcrypt():
+    """Return libcrypt's crypt_r() function bound through ctypes, or None.
+
+    ctypes releases the GIL while the foreign function runs
+    so that concurrent lookups in doveauth threads hash in parallel.
+    """
+    libname = ctypes.util.find_library("crypt")
+    if libname is None:
+        return None
+    try:
+        func = ctypes.CDLL(libname).crypt_r
+    except (OSError, AttributeError):
+        return None
+    func.argtypes = [ctypes.c_char_p, ctypes.c_char_p, ctypes.c_void_p]
+    func.restype = ctypes.c_char_p
+    return func
+
+
+_libcrypt_crypt_r = _load_libcrypt()
+
+
+def crypt(password: str, salt: str) -> str:
+    # ctypes would silently truncate at a NUL character
+    if "\0" in password or "\0" in salt:
+        raise ValueError("password and salt must not contain NUL characters")
+    if _libcrypt_crypt_r is None:
+        res = crypt_r.crypt(password, salt)
+    else:
+        data = ctypes.create_string_buffer(CRYPT_DATA_SIZE)
+        res = _libcrypt_crypt_r(password.encode("utf-8"), salt.encode("ascii"), data)
+        res = res.decode("ascii") if res else None
+    if not res or res.startswith("*"):
+        raise ValueError(f"could not hash password with salt {salt!r}")
+    return res
+
 
 def encrypt_password(password: str):
     # https://doc.dovecot.org/configuration_manual/authentication/password_schemes/
-    passhash = crypt_r.crypt(password, crypt_r.METHOD_SHA512)
+    passhash = crypt(password, crypt_r.mksalt(crypt_r.METHOD_SHA512))
     return "{SHA512-CRYPT}" + passhash
 
 
@@ -146,6 +187,8 @@ class AuthDictProxy(DictProxy):
 
         user.set_password(encrypt_password(cleartext_password))
         print(f"Created address: {addr}", file=sys.stderr)
+        # read back the stored password because concurrent creations
+        # may race and the reply must contain the hash that actually won
         return user.get_userdb_dict()
 
 
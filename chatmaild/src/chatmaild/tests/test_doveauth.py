@@ -9,6 +9,9 @@ import pytest
 import chatmaild.doveauth
 from chatmaild.doveauth import (
     AuthDictProxy,
+    crypt,
+    crypt_r,
+    encrypt_password,
     is_allowed_to_create,
 )
 from chatmaild.newemail import create_newemail_dict
@@ -28,6 +31,23 @@ def test_basic(dictproxy, gencreds):
     assert data == data2
 
 
+@pytest.mark.parametrize("libcrypt", [True, False])
+def test_encrypt_password(libcrypt, monkeypatch):
+    if not libcrypt:
+        monkeypatch.setattr(chatmaild.doveauth, "_libcrypt_crypt_r", None)
+    enc = encrypt_password("q9mr3faue1234")
+    assert enc.startswith("{SHA512-CRYPT}$6$")
+    passhash = enc.removeprefix("{SHA512-CRYPT}")
+    assert crypt("q9mr3faue1234", passhash) == passhash
+    assert crypt_r.crypt("q9mr3faue1234", passhash) == passhash
+    assert crypt("wrongpassword", passhash) != passhash
+
+    with pytest.raises(ValueError):
+        encrypt_password("q9mr3faue\x001234")
+    with pytest.raises(ValueError):
+        crypt("q9mr3faue1234", "$9$invalid")
+
+
 def test_iterate_addresses(dictproxy):
     addresses = []
 
@@ -64,6 +84,18 @@ def test_dont_overwrite_password_on_wrong_login(dictproxy):
     assert res["password"] == res2["password"]
 
 
+def test_no_hashing_for_existing_user(monkeypatch, dictproxy, gencreds):
+    addr, password = gencreds()
+    res = dictproxy.lookup_passdb(addr, password)
+
+    def fail(*args):
+        pytest.fail("existing user's password must not be hashed again")
+
+    monkeypatch.setattr(chatmaild.doveauth, "encrypt_password", fail)
+    monkeypatch.setattr(chatmaild.doveauth.crypt_r, "mksalt", fail)
+    assert dictproxy.lookup_passdb(addr, password) == res
+
+
 def test_nocreate_file(monkeypatch, tmpdir, dictproxy):
     p = tmpdir.join("nocreate")
     p.write("")
@@ -2,22 +2,32 @@
 Chat Mail pyinfra deploy.
 """
 
+import functools
+import hashlib
 import importlib.resources
 import io
+import re
 import shutil
 import subprocess
 import sys
+import tarfile
 from pathlib import Path
 
 from chatmaild.config import Config, read_config
 from pyinfra import facts, host
-from pyinfra.facts.files import File
+from pyinfra.facts.files import File, FileContents
 from pyinfra.facts.systemd import SystemdEnabled
 from pyinfra.operations import apt, files, pip, server, systemd
 
 from .acmetool import deploy_acmetool
 
+PKG_ROOT = importlib.resources.files(__package__)
+CHATMAILD_ROOT = importlib.resources.files("chatmaild")
 
+BLOCKED_PRIVACY_RE = re.compile(r"merlinux|schmieder|testrun\.org", re.IGNORECASE)
+
+
+@functools.lru_cache
 def _build_chatmaild(dist_dir) -> None:
     dist_dir = Path(dist_dir).resolve()
     if dist_dir.exists():
@@ -32,6 +42,19 @@ def _build_chatmaild(dist_dir) -> None:
     return entries[0]
 
 
+def _get_dist_digest(dist_file) -> str:
+    """Return a digest of the files contained in a source distribution,
+    independent of archive metadata like modification times
+    which change with every build."""
+    digest = hashlib.sha256()
+    with tarfile.open(dist_file) as tar:
+        for member in sorted(tar.getmembers(), key=lambda m: m.name):
+            if member.isfile():
+                digest.update(member.name.encode())
+                digest.update(tar.extractfile(member).read())
+    return digest.hexdigest()
+
+
 def remove_legacy_artifacts():
     # disable legacy doveauth-dictproxy.service
     if host.get_fact(SystemdEnabled).get("doveauth-dictproxy.service"):
@@ -57,17 +80,19 @@ def _install_remote_venv_with_chatmaild(config) -> None:
         packages=["python3-virtualenv"],
     )
 
-    files.put(
-        name="Upload chatmaild source package",
-        src=dist_file.open("rb"),
-        dest=remote_dist_file,
-        create_remote_dir=True,
-        **root_owned,
-    )
+    # The sdist is rebuilt on every deploy and thus always differs,
+    # so compare a digest of its content with the one of the last install.
+    # Only then reinstall chatmaild (which also upgrades its unpinned
+    # dependencies) and restart the services so they run the new code.
+    dist_digest = _get_dist_digest(dist_file)
+    remote_digest_path = f"{remote_dist_file}.sha256"
+    need_install = host.get_fact(FileContents, remote_digest_path) != [
+        dist_digest
+    ] or not host.get_fact(File, f"{remote_venv_dir}/bin/doveauth")
 
-    files.put(
+    ini_file = files.put(
         name=f"Upload {remote_chatmail_inipath}",
-        src=config._getbytefile(),
+        src=str(Path(config._inipath).resolve()),
         dest=remote_chatmail_inipath,
         **root_owned,
     )
@@ -83,15 +108,35 @@ def _install_remote_venv_with_chatmaild(config) -> None:
         packages=["gcc", "python3-dev"],
     )
 
-    server.shell(
-        name=f"forced pip-install {dist_file.name}",
-        commands=[
-            f"{remote_venv_dir}/bin/pip install --force-reinstall {remote_dist_file}"
-        ],
-    )
+    if need_install:
+        files.put(
+            name="Upload chatmaild source package",
+            src=str(dist_file),
+            dest=remote_dist_file,
+            create_remote_dir=True,
+            **root_owned,
+        )
+
+        server.shell(
+            name=f"forced pip-install {dist_file.name}",
+            commands=[
+                f"{remote_venv_dir}/bin/pip install --force-reinstall {remote_dist_file}"
+            ],
+        )
+
+        # uploaded after the pip-install so that a failed install
+        # is retried on the next deploy
+        files.put(
+            name="Upload chatmaild source package digest",
+            src=io.BytesIO(dist_digest.encode()),
+            dest=remote_digest_path,
+            **root_owned,
+        )
+
+    need_restart = need_install or ini_file.changed
 
     files.template(
-        src=importlib.resources.files(__package__).joinpath("metrics.cron.j2"),
+        src=PKG_ROOT.joinpath("metrics.cron.j2"),
         dest="/etc/cron.d/chatmail-metrics",
         user="root",
         group="root",
@@ -103,6 +148,7 @@ def _install_remote_venv_with_chatmaild(config) -> None:
     )
 
     # install systemd units
+    service_dir = PKG_ROOT.joinpath("service")
     for fn in (
         "doveauth",
         "filtermail",
@@ -116,12 +162,10 @@ def _install_remote_venv_with_chatmaild(config) -> None:
             remote_venv_dir=remote_venv_dir,
             mail_domain=config.mail_domain,
         )
-        source_path = importlib.resources.files(__package__).joinpath(
-            "service", f"{fn}.service.f"
-        )
+        source_path = service_dir.joinpath(f"{fn}.service.f")
         content = source_path.read_text().format(**params).encode()
 
-        files.put(
+        service_file = files.put(
             name=f"Upload {fn}.service",
             src=io.BytesIO(content),
             dest=f"/etc/systemd/system/{fn}.service",
@@ -132,27 +176,28 @@ def _install_remote_venv_with_chatmaild(config) -> None:
             service=f"{fn}.service",
             running=True,
             enabled=True,
-            restarted=True,
-            daemon_reload=True,
+            restarted=need_restart or service_file.changed,
+            daemon_reload=service_file.changed,
         )
 
 
 def _configure_opendkim(domain: str, dkim_selector: str = "dkim") -> bool:
     """Configures OpenDKIM"""
     need_restart = False
+    dkim_config = {"domain_name": domain, "opendkim_selector": dkim_selector}
 
     main_config = files.template(
-        src=importlib.resources.files(__package__).joinpath("opendkim/opendkim.conf"),
+        src=PKG_ROOT.joinpath("opendkim/opendkim.conf"),
         dest="/etc/opendkim.conf",
         user="root",
         group="root",
         mode="644",
-        config={"domain_name": domain, "opendkim_selector": dkim_selector},
+        config=dkim_config,
     )
     need_restart |= main_config.changed
 
     screen_script = files.put(
-        src=importlib.resources.files(__package__).joinpath("opendkim/screen.lua"),
+        src=PKG_ROOT.joinpath("opendkim/screen.lua"),
         dest="/etc/opendkim/screen.lua",
         user="root",
         group="root",
@@ -161,7 +206,7 @@ def _configure_opendkim(domain: str, dkim_selector: str = "dkim") -> bool:
     need_restart |= screen_script.changed
 
     final_script = files.put(
-        src=importlib.resources.files(__package__).joinpath("opendkim/final.lua"),
+        src=PKG_ROOT.joinpath("opendkim/final.lua"),
         dest="/etc/opendkim/final.lua",
         user="root",
         group="root",
@@ -178,25 +223,17 @@ def _configure_opendkim(domain: str, dkim_selector: str = "dkim") -> bool:
         present=True,
     )
 
-    keytable = files.template(
-        src=importlib.resources.files(__package__).joinpath("opendkim/KeyTable"),
-        dest="/etc/dkimkeys/KeyTable",
-        user="opendkim",
-        group="opendkim",
-        mode="644",
-        config={"domain_name": domain, "opendkim_selector": dkim_selector},
-    )
-    need_restart |= keytable.changed
+    for fn in ("KeyTable", "SigningTable"):
+        table = files.template(
+            src=PKG_ROOT.joinpath("opendkim", fn),
+            dest=f"/etc/dkimkeys/{fn}",
+            user="opendkim",
+            group="opendkim",
+            mode="644",
+            config=dkim_config,
+        )
+        need_restart |= table.changed
 
-    signing_table = files.template(
-        src=importlib.resources.files(__package__).joinpath("opendkim/SigningTable"),
-        dest="/etc/dkimkeys/SigningTable",
-        user="opendkim",
-        group="opendkim",
-        mode="644",
-        config={"domain_name": domain, "opendkim_selector": dkim_selector},
-    )
-    need_restart |= signing_table.changed
     files.directory(
         name="Add opendkim socket directory to /var/spool/postfix",
         path="/var/spool/postfix/opendkim",
@@ -223,12 +260,11 @@ def _configure_opendkim(domain: str, dkim_selector: str = "dkim") -> bool:
 
     service_file = files.put(
         name="Configure opendkim to restart once a day",
-        src=importlib.resources.files(__package__).joinpath("opendkim/systemd.conf"),
+        src=PKG_ROOT.joinpath("opendkim/systemd.conf"),
         dest="/etc/systemd/system/opendkim.service.d/10-prevent-memory-leak.conf",
     )
     need_restart |= service_file.changed
 
-
     return need_restart
 
 
@@ -254,7 +290,7 @@ def _configure_postfix(config: Config, debug: bool = False) -> bool:
     need_restart = False
 
     main_config = files.template(
-        src=importlib.resources.files(__package__).joinpath("postfix/main.cf.j2"),
+        src=PKG_ROOT.joinpath("postfix/main.cf.j2"),
         dest="/etc/postfix/main.cf",
         user="root",
         group="root",
@@ -265,7 +301,7 @@ def _configure_postfix(config: Config, debug: bool = False) -> bool:
     need_restart |= main_config.changed
 
     master_config = files.template(
-        src=importlib.resources.files(__package__).joinpath("postfix/master.cf.j2"),
+        src=PKG_ROOT.joinpath("postfix/master.cf.j2"),
         dest="/etc/postfix/master.cf",
         user="root",
         group="root",
@@ -276,9 +312,7 @@ def _configure_postfix(config: Config, debug: bool = False) -> bool:
     need_restart |= master_config.changed
 
     header_cleanup = files.put(
-        src=importlib.resources.files(__package__).joinpath(
-            "postfix/submission_header_cleanup"
-        ),
+        src=PKG_ROOT.joinpath("postfix/submission_header_cleanup"),
         dest="/etc/postfix/submission_header_cleanup",
         user="root",
         group="root",
@@ -288,7 +322,7 @@ def _configure_postfix(config: Config, debug: bool = False) -> bool:
 
     # Login map that 1:1 maps email address to login.
     login_map = files.put(
-        src=importlib.resources.files(__package__).joinpath("postfix/login_map"),
+        src=PKG_ROOT.joinpath("postfix/login_map"),
         dest="/etc/postfix/login_map",
         user="root",
         group="root",
@@ -304,7 +338,7 @@ def _configure_dovecot(config: Config, debug: bool = False) -> bool:
     need_restart = False
 
     main_config = files.template(
-        src=importlib.resources.files(__package__).joinpath("dovecot/dovecot.conf.j2"),
+        src=PKG_ROOT.joinpath("dovecot/dovecot.conf.j2"),
         dest="/etc/dovecot/dovecot.conf",
         user="root",
         group="root",
@@ -315,7 +349,7 @@ def _configure_dovecot(config: Config, debug: bool = False) -> bool:
     )
     need_restart |= main_config.changed
     auth_config = files.put(
-        src=importlib.resources.files(__package__).joinpath("dovecot/auth.conf"),
+        src=PKG_ROOT.joinpath("dovecot/auth.conf"),
         dest="/etc/dovecot/auth.conf",
         user="root",
         group="root",
@@ -323,9 +357,7 @@ def _configure_dovecot(config: Config, debug: bool = False) -> bool:
     )
     need_restart |= auth_config.changed
     lua_push_notification_script = files.put(
-        src=importlib.resources.files(__package__).joinpath(
-            "dovecot/push_notification.lua"
-        ),
+        src=PKG_ROOT.joinpath("dovecot/push_notification.lua"),
         dest="/etc/dovecot/push_notification.lua",
         user="root",
         group="root",
@@ -334,7 +366,7 @@ def _configure_dovecot(config: Config, debug: bool = False) -> bool:
     need_restart |= lua_push_notification_script.changed
 
     files.template(
-        src=importlib.resources.files(__package__).joinpath("dovecot/expunge.cron.j2"),
+        src=PKG_ROOT.joinpath("dovecot/expunge.cron.j2"),
         dest="/etc/cron.d/expunge",
         user="root",
         group="root",
@@ -342,15 +374,19 @@ def _configure_dovecot(config: Config, debug: bool = False) -> bool:
         config=config,
     )
 
-    # as per https://doc.dovecot.org/configuration_manual/os/
-    # it is recommended to set the following inotify limits
-    for name in ("max_user_instances", "max_user_watches"):
-        key = f"fs.inotify.{name}"
-        server.sysctl(
-            name=f"Change {key}",
-            key=key,
-            value=65535,
-            persist=True,
+    # install and apply dovecot's recommended inotify limits
+    sysctl_config = files.put(
+        name="Configure inotify limits for dovecot",
+        src=PKG_ROOT.joinpath("dovecot/sysctl.conf"),
+        dest="/etc/sysctl.d/60-dovecot.conf",
+        user="root",
+        group="root",
+        mode="644",
+    )
+    if sysctl_config.changed:
+        server.shell(
+            name="Apply inotify limits for dovecot",
+            commands=["sysctl -p /etc/sysctl.d/60-dovecot.conf"],
         )
 
     return need_restart
@@ -361,7 +397,7 @@ def _configure_nginx(config: Config, debug: bool = False) -> bool:
     need_restart = False
 
     main_config = files.template(
-        src=importlib.resources.files(__package__).joinpath("nginx/nginx.conf.j2"),
+        src=PKG_ROOT.joinpath("nginx/nginx.conf.j2"),
         dest="/etc/nginx/nginx.conf",
         user="root",
         group="root",
@@ -372,7 +408,7 @@ def _configure_nginx(config: Config, debug: bool = False) -> bool:
     need_restart |= main_config.changed
 
     autoconfig = files.template(
-        src=importlib.resources.files(__package__).joinpath("nginx/autoconfig.xml.j2"),
+        src=PKG_ROOT.joinpath("nginx/autoconfig.xml.j2"),
         dest="/var/www/html/.well-known/autoconfig/mail/config-v1.1.xml",
         user="root",
         group="root",
@@ -382,7 +418,7 @@ def _configure_nginx(config: Config, debug: bool = False) -> bool:
     need_restart |= autoconfig.changed
 
     mta_sts_config = files.template(
-        src=importlib.resources.files(__package__).joinpath("nginx/mta-sts.txt.j2"),
+        src=PKG_ROOT.joinpath("nginx/mta-sts.txt.j2"),
         dest="/var/www/html/.well-known/mta-sts.txt",
         user="root",
         group="root",
@@ -403,7 +439,7 @@ def _configure_nginx(config: Config, debug: bool = False) -> bool:
 
     files.put(
         name="Upload cgi newemail.py script",
-        src=importlib.resources.files("chatmaild").joinpath("newemail.py").open("rb"),
+        src=CHATMAILD_ROOT.joinpath("newemail.py"),
         dest=f"{cgi_dir}/newemail.py",
         user="root",
         group="root",
@@ -421,15 +457,15 @@ def _remove_rspamd() -> None:
 def check_config(config):
     mail_domain = config.mail_domain
     if mail_domain != "testrun.org" and not mail_domain.endswith(".testrun.org"):
-        blocked_words = "merlinux schmieder testrun.org".split()
-        for key in config.__dict__:
-            value = config.__dict__[key]
-            if key.startswith("privacy") and any(
-                x in str(value) for x in blocked_words
-            ):
-                raise ValueError(
-                    f"please set your own privacy contacts/addresses in {config._inipath}"
-                )
+        privacy_settings = "\n".join(
+            str(value)
+            for key, value in config.__dict__.items()
+            if key.startswith("privacy")
+        )
+        if BLOCKED_PRIVACY_RE.search(privacy_settings):
+            raise ValueError(
+                f"please set your own privacy contacts/addresses in {config._inipath}"
+            )
     return config
 
 
@@ -442,7 +478,7 @@ def deploy_mtail(config):
     # Using our own systemd unit instead of `/usr/lib/systemd/system/mtail.service`.
     # This allows to read from journalctl instead of log files.
     files.template(
-        src=importlib.resources.files(__package__).joinpath("mtail/mtail.service.j2"),
+        src=PKG_ROOT.joinpath("mtail/mtail.service.j2"),
         dest="/etc/systemd/system/mtail.service",
         user="root",
         group="root",
@@ -453,9 +489,7 @@ def deploy_mtail(config):
 
     mtail_conf = files.put(
         name="Mtail configuration",
-        src=importlib.resources.files(__package__).joinpath(
-            "mtail/delivered_mail.mtail"
-        ),
+        src=PKG_ROOT.joinpath("mtail/delivered_mail.mtail"),
         dest="/etc/mtail/delivered_mail.mtail",
         user="root",
         group="root",
@@ -500,7 +534,7 @@ def deploy_iroh_relay(config) -> None:
 
     systemd_unit = files.put(
         name="Upload iroh-relay systemd unit",
-        src=importlib.resources.files(__package__).joinpath("iroh-relay.service"),
+        src=PKG_ROOT.joinpath("iroh-relay.service"),
         dest="/etc/systemd/system/iroh-relay.service",
         user="root",
         group="root",
@@ -510,7 +544,7 @@ def deploy_iroh_relay(config) -> None:
 
     iroh_config = files.put(
         name="Upload iroh-relay config",
-        src=importlib.resources.files(__package__).joinpath("iroh-relay.toml"),
+        src=PKG_ROOT.joinpath("iroh-relay.toml"),
         dest="/etc/iroh-relay.toml",
         user="root",
         group="root",
@@ -527,18 +561,36 @@ def deploy_iroh_relay(config) -> None:
     )
 
 
+# pyinfra runs the deploy once per host in the same process,
+# so purely local work is cached to only happen once per run.
+
+
+@functools.lru_cache
+def _read_checked_config(config_path):
+    return check_config(read_config(config_path))
+
+
+@functools.lru_cache
+def _build_www(config):
+    from .www import build_webpages
+
+    www_path = PKG_ROOT.joinpath("../../../www").resolve()
+
+    build_dir = www_path.joinpath("build")
+    src_dir = www_path.joinpath("src")
+    build_webpages(src_dir, build_dir, config)
+    return build_dir
+
+
 def deploy_chatmail(config_path: Path, disable_mail: bool) -> None:
     """Deploy a chat-mail instance.
 
     :param config_path: path to chatmail.ini
     :param disable_mail: whether to disable postfix & dovecot
     """
-    config = read_config(config_path)
-    check_config(config)
+    config = _read_checked_config(config_path)
     mail_domain = config.mail_domain
 
-    from .www import build_webpages
-
     server.group(name="Create vmail group", group="vmail", system=True)
     server.user(name="Create vmail user", user="vmail", group="vmail", system=True)
     server.user(name="Create filtermail user", user="filtermail", system=True)
@@ -561,7 +613,7 @@ def deploy_chatmail(config_path: Path, disable_mail: bool) -> None:
     # Add our OBS repository for dovecot_no_delay
     files.put(
         name="Add Deltachat OBS GPG key to apt keyring",
-        src=importlib.resources.files(__package__).joinpath("obs-home-deltachat.gpg"),
+        src=PKG_ROOT.joinpath("obs-home-deltachat.gpg"),
         dest="/etc/apt/keyrings/obs-home-deltachat.gpg",
         user="root",
         group="root",
@@ -613,38 +665,24 @@ def deploy_chatmail(config_path: Path, disable_mail: bool) -> None:
         domains=tls_domains,
     )
 
+    # Install all service packages in one apt transaction
+    # to avoid one package-fact roundtrip and apt-get run per service.
     apt.packages(
-        # required for setfacl for echobot
-        name="Install acl",
-        packages="acl",
-    )
-
-    apt.packages(
-        name="Install Postfix",
-        packages="postfix",
-    )
-
-    apt.packages(
-        name="Install Dovecot",
-        packages=["dovecot-imapd", "dovecot-lmtpd"],
-    )
-
-    apt.packages(
-        name="Install nginx",
-        packages=["nginx", "libnginx-mod-stream"],
-    )
-
-    apt.packages(
-        name="Install fcgiwrap",
-        packages=["fcgiwrap"],
+        name="Install acl, Postfix, Dovecot, nginx and fcgiwrap",
+        packages=[
+            # required for setfacl for echobot
+            "acl",
+            "postfix",
+            "dovecot-imapd",
+            "dovecot-lmtpd",
+            "nginx",
+            "libnginx-mod-stream",
+            "fcgiwrap",
+        ],
     )
 
-    www_path = importlib.resources.files(__package__).joinpath("../../../www").resolve()
-
-    build_dir = www_path.joinpath("build")
-    src_dir = www_path.joinpath("src")
-    build_webpages(src_dir, build_dir, config)
-    files.rsync(f"{build_dir}/", "/var/www/html", flags=["-avz"])
+    build_dir = _build_www(config)
+    files.rsync(f"{build_dir}/", "/var/www/html", flags=["-avz", "--checksum"])
 
     _install_remote_venv_with_chatmaild(config)
     debug = False
@@ -701,7 +739,7 @@ def deploy_chatmail(config_path: Path, disable_mail: bool) -> None:
 
     journald_conf = files.put(
         name="Configure journald",
-        src=importlib.resources.files(__package__).joinpath("journald.conf"),
+        src=PKG_ROOT.joinpath("journald.conf"),
         dest="/etc/systemd/journald.conf",
         user="root",
         group="root",
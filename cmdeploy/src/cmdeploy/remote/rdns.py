@@ -12,7 +12,7 @@ All functions of this module
 
 import re
 
-from .rshell import CalledProcessError, shell
+from .rshell import shell
 
 
 def perform_initial_checks(mail_domain):
@@ -41,13 +41,12 @@ def perform_initial_checks(mail_domain):
 
 
 def get_dkim_entry(mail_domain, dkim_selector):
-    try:
-        dkim_pubkey = shell(
-            f"openssl rsa -in /etc/dkimkeys/{dkim_selector}.private "
-            "-pubout 2>/dev/null | awk '/-/{next}{printf(\"%s\",$0)}'"
-        )
-    except CalledProcessError:
-        return
+    pem = shell(
+        f"openssl rsa -in /etc/dkimkeys/{dkim_selector}.private -pubout 2>/dev/null",
+        fail_ok=True,
+    )
+    # strip the "-----BEGIN/END PUBLIC KEY-----" lines and join the base64 body
+    dkim_pubkey = "".join(line for line in pem.splitlines() if "-" not in line)
     dkim_value_raw = f"v=DKIM1;k=rsa;p={dkim_pubkey};s=email;t=s"
     dkim_value = '" "'.join(re.findall(".{1,255}", dkim_value_raw))
     web_dkim_value = "".join(re.findall(".{1,255}", dkim_value_raw))
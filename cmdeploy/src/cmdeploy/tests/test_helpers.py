@@ -1,5 +1,13 @@
 import importlib.resources
+import os
+import tarfile
+from types import SimpleNamespace
 
+import pytest
+from pyinfra.facts.files import FileContents
+
+import cmdeploy
+from cmdeploy import _get_dist_digest, check_config
 from cmdeploy.www import build_webpages
 
 
@@ -11,3 +19,101 @@ def test_build_webpages(tmp_path, make_config):
     build_dir = tmp_path.joinpath("build")
     build_webpages(src_dir, build_dir, config)
     assert len([x for x in build_dir.iterdir() if x.suffix == ".html"]) >= 3
+
+
+def test_build_webpages_keeps_unchanged_files(tmp_path, make_config):
+    pkgroot = importlib.resources.files("cmdeploy")
+    src_dir = pkgroot.joinpath("../../../www/src").resolve()
+    config = make_config("chat.example.org")
+    build_dir = tmp_path.joinpath("build")
+    build_webpages(src_dir, build_dir, config)
+    stale_path = build_dir.joinpath("removed-page.html")
+    stale_path.write_text("stale")
+    index_path = build_dir.joinpath("index.html")
+    os.utime(index_path, (0, 0))
+
+    build_webpages(src_dir, build_dir, config)
+    assert index_path.stat().st_mtime == 0
+    assert not stale_path.exists()
+
+
+def test_check_config(make_config):
+    config = make_config("chat.example.org")
+    assert check_config(config) is config
+
+    config = make_config("chat.example.org", {"privacy_mail": "privacy@Merlinux.eu"})
+    with pytest.raises(ValueError):
+        check_config(config)
+
+    config = make_config("chat.testrun.org")
+    assert check_config(config) is config
+
+
+def test_get_dist_digest_ignores_mtime(tmp_path):
+    src = tmp_path.joinpath("src.py")
+    src.write_text("print(42)")
+
+    def make_dist(name, mtime):
+        os.utime(src, (mtime, mtime))
+        path = tmp_path.joinpath(name)
+        with tarfile.open(path, "w:gz") as tar:
+            tar.add(src, arcname="pkg/src.py")
+        return path
+
+    dist1 = make_dist("dist1.tar.gz", 1000)
+    dist2 = make_dist("dist2.tar.gz", 2000)
+    assert dist1.read_bytes() != dist2.read_bytes()
+    assert _get_dist_digest(dist1) == _get_dist_digest(dist2)
+
+    src.write_text("print(43)")
+    assert _get_dist_digest(make_dist("dist3.tar.gz", 1000)) != _get_dist_digest(dist1)
+
+
+class OperationRecorder:
+    """Stand-in for a pyinfra operations module recording all calls."""
+
+    def __init__(self, calls):
+        self._calls = calls
+
+    def __getattr__(self, opname):
+        def op(**kwargs):
+            self._calls.append((opname, kwargs))
+            return SimpleNamespace(changed=False)
+
+        return op
+
+
+@pytest.mark.parametrize("installed", [True, False])
+def test_install_chatmaild_restarts_only_after_install(
+    installed, tmp_path, monkeypatch, example_config
+):
+    src = tmp_path.joinpath("src.py")
+    src.write_text("print(42)")
+    dist_file = tmp_path.joinpath("chatmaild-0.2.tar.gz")
+    with tarfile.open(dist_file, "w:gz") as tar:
+        tar.add(src, arcname="chatmaild-0.2/src.py")
+    digest = _get_dist_digest(dist_file)
+
+    def get_fact(fact, *args):
+        if fact is FileContents:
+            return [digest] if installed else None
+        return installed
+
+    calls = []
+    monkeypatch.setattr(cmdeploy, "_build_chatmaild", lambda dist_dir: dist_file)
+    monkeypatch.setattr(cmdeploy, "remove_legacy_artifacts", lambda: None)
+    monkeypatch.setattr(cmdeploy, "host", SimpleNamespace(get_fact=get_fact))
+    for name in ("apt", "files", "pip", "server", "systemd"):
+        monkeypatch.setattr(cmdeploy, name, OperationRecorder(calls))
+
+    cmdeploy._install_remote_venv_with_chatmaild(example_config)
+
+    pip_installs = [kw for op, kw in calls if op == "shell" and "pip" in kw["name"]]
+    restarts = [kw["restarted"] for op, kw in calls if op == "service"]
+    assert restarts
+    if installed:
+        assert not pip_installs
+        assert not any(restarts)
+    else:
+        assert len(pip_installs) == 1
+        assert all(restarts)
@@ -6,7 +6,7 @@ import webbrowser
 
 import markdown
 from chatmaild.config import read_config
-from jinja2 import Template
+from jinja2 import Environment
 
 from .genqr import gen_qr_png_data
 
@@ -21,13 +21,20 @@ def snapshot_dir_stats(somedir):
     return d
 
 
-def prepare_template(source):
+def prepare_template(source, md):
     assert source.exists(), source
     render_vars = {}
     render_vars["pagename"] = "home" if source.stem == "index" else source.stem
-    render_vars["markdown_html"] = markdown.markdown(source.read_text())
-    page_layout = source.with_name("page-layout.html").read_text()
-    return render_vars, page_layout
+    render_vars["markdown_html"] = md.reset().convert(source.read_text())
+    return render_vars
+
+
+def write_if_changed(path, data):
+    """Write bytes to path unless it already has exactly this content,
+    so that unchanged build artifacts keep their mtime."""
+    if path.exists() and path.read_bytes() == data:
+        return
+    path.write_bytes(data)
 
 
 def build_webpages(src_dir, build_dir, config):
@@ -68,34 +75,45 @@ def _build_webpages(src_dir, build_dir, config):
         build_dir.mkdir()
 
     qr_path = build_dir.joinpath(f"qr-chatmail-invite-{mail_domain}.png")
-    qr_path.write_bytes(gen_qr_png_data(mail_domain).read())
+    write_if_changed(qr_path, gen_qr_png_data(mail_domain).read())
+    targets = {qr_path}
+
+    # markdown converter, jinja2 environment and page layout
+    # are shared by all pages
+    md = markdown.Markdown()
+    env = Environment()
+    page_layout = src_dir.joinpath("page-layout.html").read_text()
+    length_vars = dict(
+        username_min_length=int_to_english(config.username_min_length),
+        username_max_length=int_to_english(config.username_max_length),
+        password_min_length=int_to_english(config.password_min_length),
+    )
 
     for path in src_dir.iterdir():
         if path.suffix == ".md":
-            render_vars, content = prepare_template(path)
-            render_vars["username_min_length"] = int_to_english(
-                config.username_min_length
-            )
-            render_vars["username_max_length"] = int_to_english(
-                config.username_max_length
-            )
-            render_vars["password_min_length"] = int_to_english(
-                config.password_min_length
-            )
+            render_vars = prepare_template(path, md)
+            render_vars.update(length_vars)
+            content = page_layout
             target = build_dir.joinpath(path.stem + ".html")
 
             # recursive jinja2 rendering
             while 1:
-                new = Template(content).render(config=config, **render_vars)
+                new = env.from_string(content).render(config=config, **render_vars)
                 if new == content:
                     break
                 content = new
 
-            with target.open("w") as f:
-                f.write(content)
+            write_if_changed(target, content.encode())
+            targets.add(target)
         elif path.name != "page-layout.html":
             target = build_dir.joinpath(path.name)
-            target.write_bytes(path.read_bytes())
+            write_if_changed(target, path.read_bytes())
+            targets.add(target)
+
+    # remove stale artifacts of pages that no longer exist
+    for path in build_dir.iterdir():
+        if path.is_file() and path not in targets:
+            path.unlink()
     return build_dir
 
 